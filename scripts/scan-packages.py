@@ -1,11 +1,29 @@
 #!/usr/bin/env python3
 
+import functools
+import gzip
+import hashlib
 import json
+import os
+import re
+import shutil
 import sys
+import urllib.error
 import urllib.request
-import csv
-from pathlib import Path
-from typing import Dict, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set
+
+try:
+    # orjson is considerably faster on large lockfiles; fall back to stdlib json
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # ijson streams package-lock.json entry by entry instead of building the whole tree
+    import ijson
+except ImportError:
+    ijson = None
 
 # Colors for output
 RED = '\033[0;31m'
@@ -15,54 +33,153 @@ NC = '\033[0m'  # No Color
 
 CSV_URL = "https://raw.githubusercontent.com/wiz-sec-public/wiz-research-iocs/main/reports/shai-hulud-2-packages.csv"
 CSV_FILE = "shai-hulud-2-packages.csv"
+CSV_META_FILE = "shai-hulud-2-packages.meta"
+CSV_CACHE_FILE = "shai-hulud-2-packages.cache.json"
 PACKAGE_JSON = "package.json"
 PACKAGE_LOCK = "package-lock.json"
 
+# Leading range operators (^, ~, >=, <, ...) followed by the first version token
+VERSION_RE = re.compile(r'[\^~>=<\s]*(\S+)')
+
+
+def csv_sha256() -> str:
+    """Return the sha256 hex digest of the local infected packages CSV."""
+    digest = hashlib.sha256()
+    with open(CSV_FILE, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-def download_csv(url=CSV_URL):
-    """Download the latest infected packages CSV."""
-    print("⬇️  Downloading latest infected packages list...")
+
+def download_csv(url=CSV_URL, log=print):
+    """Download the latest infected packages CSV, skipping the transfer if it is unchanged."""
+    log("⬇️  Downloading latest infected packages list...")
+    
+    headers = {'Accept-Encoding': 'gzip'}
+    
+    # Ask for the body only when it changed since the copy we already have,
+    # provided the local CSV is still byte-for-byte the file recorded in the
+    # .meta file (e.g. not edited for --test); this is a consistency check
+    # between two local files, not a verification against upstream
+    if os.path.isfile(CSV_FILE):
+        try:
+            with open(CSV_META_FILE, 'r') as f:
+                meta = json.load(f)
+            if meta.get('size') != os.path.getsize(CSV_FILE) or meta.get('sha256') != csv_sha256():
+                meta = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        except (OSError, ValueError):
+            pass
+    
     try:
-        with urllib.request.urlopen(url) as response:
-            content = response.read().decode('utf-8')
-            with open(CSV_FILE, 'w') as f:
-                f.write(content)
-        print(f"{GREEN}✓{NC} Successfully downloaded CSV")
+        request = urllib.request.Request(url, headers=headers)
+        # Stream to a temporary file and only swap it in once the whole body
+        # has arrived, so an interrupted download never replaces the CSV
+        with urllib.request.urlopen(request) as response:
+            body = response
+            if response.headers.get('Content-Encoding') == 'gzip':
+                # The list is very repetitive, so it is fetched compressed
+                body = gzip.GzipFile(fileobj=response)
+            try:
+                with open(CSV_FILE + '.tmp', 'wb') as f:
+                    shutil.copyfileobj(body, f, 65536)
+                # Chunked reads return b'' instead of raising when the connection
+                # drops early, so make sure all of Content-Length was received
+                if response.length:
+                    raise EOFError(f"connection closed with {response.length} more bytes expected")
+                os.replace(CSV_FILE + '.tmp', CSV_FILE)
+            finally:
+                # Don't leave a partial download behind in the project
+                if os.path.exists(CSV_FILE + '.tmp'):
+                    os.remove(CSV_FILE + '.tmp')
+            # Only reached once the body has been verified complete and moved
+            # into place, so the validators always describe a whole download
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'size': os.path.getsize(CSV_FILE),
+                'sha256': csv_sha256(),
+            }
+        try:
+            with open(CSV_META_FILE, 'w') as f:
+                json.dump(meta, f)
+        except OSError:
+            pass
+        log(f"{GREEN}✓{NC} Successfully downloaded CSV")
         return True
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            log(f"{GREEN}✓{NC} Infected packages list is up to date")
+            return True
+        log(f"{RED}✗{NC} Failed to download CSV: {e}")
+        return False
     except Exception as e:
-        print(f"{RED}✗{NC} Failed to download CSV: {e}")
+        log(f"{RED}✗{NC} Failed to download CSV: {e}")
         return False
 
 
-def load_infected_packages() -> Set[Tuple[str, str]]:
-    """Load infected packages from CSV into a set for fast lookup."""
-    infected = set()
+def load_infected_packages() -> Dict[str, Set[str]]:
+    """Load infected packages from CSV into a mapping of package name to infected versions."""
+    # Reuse the list parsed on a previous run while the CSV is still the file
+    # (same size and modification time) the cache was built from
+    try:
+        csv_stat = os.stat(CSV_FILE)
+        with open(CSV_CACHE_FILE, 'rb') as f:
+            cache = json_loads(f.read())
+        if cache['csv_size'] == csv_stat.st_size and cache['csv_mtime_ns'] == csv_stat.st_mtime_ns:
+            return {sys.intern(name): set(versions) for name, versions in cache['packages'].items()}
+    except Exception:
+        pass
+    
     try:
-        with open(CSV_FILE, 'r') as f:
-            reader = csv.reader(f)
-            next(reader)  # Skip header
-            for row in reader:
-                if len(row) >= 2:
-                    package = row[0].strip()
-                    version = row[1].strip().lstrip('= ')
-                    infected.add((package, version))
+        with open(CSV_FILE, 'rb') as f:
+            csv_stat = os.fstat(f.fileno())
+            lines = f.read().decode('utf-8').splitlines()
+        # The IoC list is plain "package,version" rows without quoting, so
+        # split in C instead of going through the csv module's state machine
+        infected = {}
+        for line in lines[1:]:  # Skip header
+            package, sep, rest = line.partition(',')
+            if sep:
+                version = rest.partition(',')[0].strip().lstrip('= ')
+                infected.setdefault(sys.intern(package.strip()), set()).add(version)
+        
+        cache = {
+            'csv_size': csv_stat.st_size,
+            'csv_mtime_ns': csv_stat.st_mtime_ns,
+            'packages': {name: sorted(versions) for name, versions in infected.items()},
+        }
+        try:
+            with open(CSV_CACHE_FILE, 'w') as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
         return infected
     except Exception as e:
         print(f"{RED}✗{NC} Failed to read CSV: {e}")
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=4096)
+def clean_version(version: str) -> str:
+    """Strip range operators from a version spec and keep its first version (^1.2.3 -> 1.2.3)."""
+    return VERSION_RE.match(version).group(1)
+
+
 def load_package_json() -> Dict[str, str]:
     """Load and parse package.json."""
-    if not Path(PACKAGE_JSON).exists():
+    if not os.path.isfile(PACKAGE_JSON):
         print(f"{RED}✗{NC} package.json not found in current directory")
         sys.exit(1)
     
     print(f"{GREEN}✓{NC} Found package.json")
     
     try:
-        with open(PACKAGE_JSON, 'r') as f:
-            pkg = json.load(f)
+        with open(PACKAGE_JSON, 'rb') as f:
+            pkg = json_loads(f.read())
         
         # Collect all dependencies
         all_deps = {}
@@ -74,8 +191,7 @@ def load_package_json() -> Dict[str, str]:
         cleaned_deps = {}
         for name, version in all_deps.items():
             # Remove common version prefixes and take first part
-            clean_version = version.lstrip('^~>=<').split()[0]
-            cleaned_deps[name] = clean_version
+            cleaned_deps[sys.intern(name)] = clean_version(version)
         
         return cleaned_deps
     except Exception as e:
@@ -83,49 +199,87 @@ def load_package_json() -> Dict[str, str]:
         sys.exit(1)
 
 
-def load_package_lock() -> Dict[str, str]:
-    """Load and parse package-lock.json to get all dependencies including transitive ones."""
-    if not Path(PACKAGE_LOCK).exists():
+def package_name_from_path(package_path: str) -> str:
+    """Get the package name from a package-lock.json path like node_modules/a/node_modules/@scope/b."""
+    # Only the segment after the last node_modules/ names the package
+    idx = package_path.rfind('node_modules/')
+    package_name = package_path[idx + 13:] if idx >= 0 else package_path
+    
+    # Handle scoped packages: keep scope and package name only
+    if package_name.startswith('@'):
+        slash = package_name.find('/', package_name.find('/') + 1)
+        if slash >= 0:
+            package_name = package_name[:slash]
+    
+    return package_name
+
+
+def load_package_lock() -> Dict[str, Set[str]]:
+    """Load and parse package-lock.json to get every installed version of all dependencies including transitive ones."""
+    if not os.path.isfile(PACKAGE_LOCK):
         return {}
     
     print(f"{GREEN}✓{NC} Found package-lock.json")
     
     try:
-        with open(PACKAGE_LOCK, 'r') as f:
-            lock = json.load(f)
-        
         all_packages = {}
         
         # Handle both lockfileVersion 1 and 2/3 formats
-        if 'packages' in lock:
-            # Version 2/3 format
-            for package_path, package_info in lock.get('packages', {}).items():
+        with open(PACKAGE_LOCK, 'rb') as f:
+            if ijson is not None:
+                # lockfileVersion comes first in the file, so this stops early; it
+                # tells which sections exist (v1: dependencies, v2: both, v3: packages)
+                # so the streaming passes below skip sections that aren't there
+                lockfile_version = next(ijson.items(f, 'lockfileVersion'), None)
+                f.seek(0)
+                
+                # Version 2/3 format, streamed one entry at a time instead of
+                # materializing the whole lockfile
+                if lockfile_version == 1:
+                    packages = ()
+                else:
+                    packages = ijson.kvitems(f, 'packages', use_float=True)
+            else:
+                lock = json_loads(f.read())
+                # Version 2/3 format
+                packages = lock.get('packages', {}).items()
+            
+            # Nested installs share a name with the hoisted copy but may have a
+            # different version, so every version is kept
+            for package_path, package_info in packages:
                 if package_path == '':  # Skip root package
                     continue
                 
-                # Extract package name from path (remove node_modules prefix)
-                package_name = package_path.replace('node_modules/', '')
-                
-                # Handle scoped packages
-                if package_name.startswith('@'):
-                    parts = package_name.split('/')
-                    if len(parts) >= 2:
-                        # Keep scope and package name only
-                        package_name = f"{parts[0]}/{parts[1]}"
-                
                 if 'version' in package_info:
-                    all_packages[package_name] = package_info['version']
-        
-        if 'dependencies' in lock:
+                    package_name = sys.intern(package_name_from_path(package_path))
+                    all_packages.setdefault(package_name, set()).add(package_info['version'])
+            
             # Version 1 format or additional dependencies
-            def extract_deps(deps_dict):
-                for name, info in deps_dict.items():
-                    if isinstance(info, dict) and 'version' in info:
-                        all_packages[name] = info['version']
-                    if isinstance(info, dict) and 'dependencies' in info:
-                        extract_deps(info['dependencies'])
+            if ijson is not None:
+                if isinstance(lockfile_version, int) and lockfile_version >= 3:
+                    dependencies = ()
+                else:
+                    f.seek(0)
+                    dependencies = ijson.kvitems(f, 'dependencies', use_float=True)
+            else:
+                dependencies = lock.get('dependencies', {}).items()
             
-            extract_deps(lock['dependencies'])
+            # Walk nested dependencies depth-first with an explicit stack of
+            # iterators, keeping the visiting order without Python recursion
+            stack = [iter(dependencies)]
+            while stack:
+                for name, info in stack[-1]:
+                    if not isinstance(info, dict):
+                        continue
+                    version = info.get('version')
+                    if version is not None:
+                        all_packages.setdefault(sys.intern(name), set()).add(version)
+                    nested = info.get('dependencies')
+                    if nested:
+                        stack.append(iter(nested.items()))
+                        break
+                else:
+                    stack.pop()
         
         return all_packages
     except Exception as e:
@@ -133,15 +287,21 @@ def load_package_lock() -> Dict[str, str]:
         return {}
 
 
-def scan_packages(installed: Dict[str, str], infected: Set[Tuple[str, str]]) -> list:
-    """Scan installed packages against infected list."""
-    found_infections = []
+def scan_packages(installed: Dict[str, Set[str]], infected: Dict[str, Set[str]]) -> list:
+    """Scan every installed version of each package against infected list."""
+    # Prefilter on package name with a C-level keys intersection; most scans
+    # share no names with the infected list and return without a Python loop
+    candidates = installed.keys() & infected.keys()
+    if not candidates:
+        return []
     
-    for package_name, version in installed.items():
-        if (package_name, version) in infected:
-            found_infections.append((package_name, version))
-    
-    return found_infections
+    # filter() walks installed in C to keep installed order, so only the
+    # shared names reach the Python loop
+    return [
+        (package_name, version)
+        for package_name in filter(candidates.__contains__, installed)
+        for version in sorted(installed[package_name] & infected[package_name])
+    ]
 
 
 def main():
@@ -152,26 +312,30 @@ def main():
     
     # Check for test mode
     test_mode = '--test' in sys.argv
+    download = None
+    download_log = []
     
     if test_mode:
         print(f"{YELLOW}🧪 TEST MODE ENABLED{NC}")
         print("Using local test CSV file...")
         print()
-        if not Path(CSV_FILE).exists():
+        if not os.path.isfile(CSV_FILE):
             print(f"{RED}✗{NC} Test CSV not found. Creating test file...")
             print()
             print("Add a package from your package.json to the CSV for testing.")
             print("Example: react,19.1.1")
             sys.exit(1)
     else:
-        # Download CSV
-        if not download_csv():
-            sys.exit(1)
+        # Download CSV in the background while package.json and package-lock.json
+        # are parsed; its messages are printed once it has finished
+        pool = ThreadPoolExecutor(max_workers=1)
+        download = pool.submit(download_csv, log=download_log.append)
+        pool.shutdown(wait=False)
     
     # Load package.json
     print()
     print("📦 Extracting dependencies from package.json...")
-    installed_packages = load_package_json()
+    installed_packages = {name: {version} for name, version in load_package_json().items()}
     total_deps = len(installed_packages)
     print(f"{GREEN}✓{NC} Found {total_deps} packages in package.json")
     
@@ -181,18 +345,27 @@ def main():
     lock_packages = load_package_lock()
     if lock_packages:
         print(f"{GREEN}✓{NC} Found {len(lock_packages)} packages in package-lock.json (including transitive dependencies)")
-        # Merge lock packages into installed packages
-        for name, version in lock_packages.items():
-            if name not in installed_packages:
-                installed_packages[name] = version
+        # Merge lock packages into installed packages, keeping every version
+        for name, versions in lock_packages.items():
+            installed_packages.setdefault(name, set()).update(versions)
         total_with_lock = len(installed_packages)
         print(f"{GREEN}✓{NC} Total unique packages to scan: {total_with_lock}")
     else:
         print(f"{YELLOW}⚠{NC} No package-lock.json found, scanning package.json only")
     
+    # Wait for the CSV download
+    if download is not None:
+        print()
+        downloaded = download.result()
+        for line in download_log:
+            print(line)
+        if not downloaded:
+            sys.exit(1)
+    
     # Load infected packages list
     infected_packages = load_infected_packages()
-    print(f"{GREEN}✓{NC} Loaded {len(infected_packages)} infected package entries")
+    infected_entries = sum(len(versions) for versions in infected_packages.values())
+    print(f"{GREEN}✓{NC} Loaded {infected_entries} infected package entries")
     
     # Scan for infections
     print()